@@ -1,10 +1,16 @@
 import shutil
-import string
 import textwrap
-from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Sequence
 
-from src.globals import GROUP_COUNT
+try:
+    from tesserocr import PSM, PyTessBaseAPI
+except ImportError:
+    # messages fall back to pytesseract without an api
+    PyTessBaseAPI = None
+
+from src.crack import code_diff_from_words_with_same_diff, signature
+from src.globals import CODE_BASE, GROUP_COUNT
 from src.message import Message
 from src.support import AppendOnlyFileBackedSet, JSONBackedDict
 
@@ -12,9 +18,9 @@ from src.support import AppendOnlyFileBackedSet, JSONBackedDict
 class Main:
     dictionary_words: set[str]
     seen_messages: set[str]
-    receiver_frequency: dict[str, int]
-    sender_frequency: dict[str, int]
-    word_frequency: dict[str, int]
+    receiver_frequency: JSONBackedDict
+    sender_frequency: JSONBackedDict
+    word_frequency: JSONBackedDict
 
     def __init__(self):
         self.dictionary_words: set[str] = AppendOnlyFileBackedSet(
@@ -23,91 +29,59 @@ class Main:
         self.seen_messages: set[str] = AppendOnlyFileBackedSet(
             "seen_messages.txt", "seen messages", " messages", is_json=True
         )
-        self.receiver_frequency: dict[str, int] = JSONBackedDict(
-            "receiver_frequency.json", "receiver frequency", " receivers"
+        # frequency words are indexed by signature, so the targets for a cipher word are a single lookup
+        self.receiver_frequency: JSONBackedDict = JSONBackedDict(
+            "receiver_frequency.json", "receiver frequency", " receivers", index_key=self.get_word_signature
+        )
+        self.sender_frequency: JSONBackedDict = JSONBackedDict(
+            "sender_frequency.json", "sender frequency", " senders", index_key=self.get_word_signature
+        )
+        self.word_frequency: JSONBackedDict = JSONBackedDict(
+            "word_frequency.json", "word frequency", " words", index_key=self.get_word_signature
         )
-        self.sender_frequency: dict[str, int] = JSONBackedDict("sender_frequency.json", "sender frequency", " senders")
-        self.word_frequency: dict[str, int] = JSONBackedDict("word_frequency.json", "word frequency", " words")
-        self.dictionary_words.load()
-        self.seen_messages.load()
-        self.receiver_frequency.load()
-        self.sender_frequency.load()
-        self.word_frequency.load()
+        # load the tesseract model once, every message reuses it
+        # tesserocr releases the GIL while it loads, so it can happen alongside loading the files
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            ocr_api = executor.submit(PyTessBaseAPI, psm=PSM.SINGLE_BLOCK) if PyTessBaseAPI else None
+            self.dictionary_words.load()
+            self.seen_messages.load()
+            self.receiver_frequency.load()
+            self.sender_frequency.load()
+            self.word_frequency.load()
+            self.ocr_api = ocr_api.result() if ocr_api else None
 
     def is_clear_text(self, words: Sequence) -> bool:
         # is this clear text or cipher text?
         # if a good part of words are in the dictionary or are numbers, it's clear text
-        clear_words = 0
-        # get the receiver and sender without the equals sign
-        for word in words:
-            if word and word in self.dictionary_words or word.isdigit():
-                clear_words += 1
-        if clear_words > len(words) / 4:
-            return True
-        return False
+        # count with map, so the membership and digit checks loop in C
+        # dictionary words are all letters, so no word is counted twice
+        clear_words = sum(map(self.dictionary_words.__contains__, words)) + sum(map(str.isdigit, words))
+        return clear_words > len(words) / 4
 
     def handle_clear_text(self, message: Message):
         self.seen_messages.add(message.text)
         for word in message.body:
-            self.word_frequency[word] = self.word_frequency.get(word, 0) + 1
+            self.word_frequency.increment(word)
         if message.receiver:
-            self.receiver_frequency[message.receiver] = self.receiver_frequency.get(message.receiver, 0) + 1
+            self.receiver_frequency.increment(message.receiver)
         if message.sender:
-            self.sender_frequency[message.sender] = self.sender_frequency.get(message.sender, 0) + 1
-
-    @staticmethod
-    def get_potential_targets(word: str, frequency: dict[str, int]) -> list[str]:
-        return map(
-            itemgetter(0),
-            reversed(
-                sorted(
-                    [(word, frequency) for word, frequency in frequency.items() if len(word) == len(word)],
-                    key=itemgetter(1),
-                )
-            ),
-        )
-
-    @staticmethod
-    def custom_ord(char: str) -> int:
-        # custom ord function that puts does uppercase letters then numbers (0-35)
-        if char.isupper():
-            return ord(char) - 64
-        if char.isdigit():
-            return int(char) + 26
-        raise ValueError(f"Invalid char {char}")
+            self.sender_frequency.increment(message.sender)
 
     @staticmethod
-    def custom_chr(ord: int) -> str:
-        # custom chr function that puts does uppercase letters then numbers (0-35)
-        if ord < 27:
-            return chr(ord + 64)
-        if ord < 36:
-            return str(ord - 26)
-        raise ValueError(f"Invalid ord {ord}")
-
-    @staticmethod
-    def make_groups(word: str) -> tuple[tuple[str]]:
-        # divide letters in groups of GROUP_COUNT, via round robin
-        return tuple(tuple(word[i::GROUP_COUNT]) for i in range(GROUP_COUNT))
-
-    @staticmethod
-    def make_diffs(groups: tuple[tuple[str]]) -> tuple[tuple[int]]:
-        # get the pattern of differences between character in a group, using custom ord
-        return tuple(
-            tuple(Main.custom_ord(x) - Main.custom_ord(y) for x, y in zip(group, group[1:])) for group in groups
-        )
-
-    @staticmethod
-    def code_diff_from_groups_with_same_diff(
-        target_groups: tuple[tuple[str]], source_groups: tuple[tuple[str]]
-    ) -> tuple[int]:
-        # these groups have the same differences, so return the amount of shifts needed to get from source to target, once for each group
-        # if the word isn't long enough return a partial code
-        return tuple(
-            Main.custom_ord(source_group[0]) - Main.custom_ord(target_group[0])
-            for target_group, source_group in zip(target_groups, source_groups)
-            if target_group and source_group
-        )
+    def get_word_signature(word: str) -> Optional[tuple[int, tuple[int], int]]:
+        # words with characters outside the code alphabet can't be diffed
+        try:
+            return signature(word)
+        except ValueError:
+            return None
+
+    def get_potential_targets(self, word: str, frequency: JSONBackedDict) -> list[str]:
+        # only words with the same length and dashes can be a match
+        # the pattern of differences between characters in a group must be the same for all groups to match a target word
+        word_signature = self.get_word_signature(word)
+        if word_signature is None:
+            return []
+        return frequency.sorted_keys(word_signature)
 
     def handle_potential_match(
         self,
@@ -117,7 +91,7 @@ class Main:
         code_diff: Sequence[int],
     ) -> Optional[bool]:
         print(
-            f"We think {source_type} {source_word!r} is {target_word!r}, using a code difference of {' '.join(str(x) for x in code_diff)}."
+            f"We think {source_type} {source_word!r} is {target_word!r}, using a code difference of {' '.join(map(str, code_diff))}."
         )
         if len(code_diff) < GROUP_COUNT:
             print("This is a partial code, which may help manual decryption.")
@@ -143,73 +117,38 @@ class Main:
             value = int(value)
             break
         # using the value of the nob, turn the code_diff into a code
-        code = tuple((x + value) % 36 for x in code_diff)
-        print(f"The code is {' '.join(str(x) for x in code)}.")
+        code = tuple((x + value) % CODE_BASE for x in code_diff)
+        print(f"The code is {' '.join(map(str, code))}.")
         print(f"Keep looking at matches? (Y/n)")
         if input().lower() == "n":
             return True
 
-    @staticmethod
-    def get_clear_text_translator(code: Sequence[int], target_letter: str, source_letter: str) -> str:
-        # get the clear text translator for a single letter, using custom ord & custom chr
-        digits = string.ascii_uppercase + string.digits
-        # rotate the soruce digits so the target letter is at the start
-        source_digits = digits[digits.index(target_letter) :] + digits[: digits.index(target_letter)]
-        # rotate the target digits so the target letter is at the start
-        target_digits = digits[digits.index(target_letter) :] + digits[: digits.index(target_letter)]
-        return str.maketrans(source_digits, target_digits)
+    def handle_word_decoding(self, source_type: str, source_word: str, frequency: JSONBackedDict) -> Optional[bool]:
+        # find target words that match the pattern of the cipher word, sorted by most frequent first
+        for potential_target in self.get_potential_targets(source_word, frequency):
+            code_diff = code_diff_from_words_with_same_diff(potential_target, source_word)
+            # we can only show the user the source word and target word, since we don't know the position of the code between words.
+            if self.handle_potential_match(source_type, source_word, potential_target, code_diff):
+                return True
 
     def handle_receiver_decoding(self, message: Message) -> Optional[bool]:
         # we can help decipher the receiver quite a bit, since we know there are no gaps in the sequence of rotations
-        # find receiver words that match the length of the cipher receiver, sorted by most frequent first
-        potential_receivers = self.get_potential_targets(message.receiver, self.receiver_frequency)
-        # the pattern of differences between characters in a group must be the same for all groups to match a target word
-        reciever_groups = self.make_groups(message.receiver)
-        receiver_diffs = self.make_diffs(reciever_groups)
-        for potential_receiver in potential_receivers:
-            potential_receiver_groups = self.make_groups(potential_receiver)
-            potential_receiver_diffs = self.make_diffs(potential_receiver_groups)
-            if receiver_diffs == potential_receiver_diffs:
-                code_diff = self.code_diff_from_groups_with_same_diff(potential_receiver_groups, reciever_groups)
-                # we can only show the user the source word and target word, since we don't know the position of the code between words.
-                if self.handle_potential_match("the receiver", message.receiver, potential_receiver, code_diff):
-                    return True
+        return self.handle_word_decoding("the receiver", message.receiver, self.receiver_frequency)
 
     def handle_sender_decoding(self, message: Message) -> Optional[bool]:
         # the sender is a bit harder to decode, since we don't know where the code starts
-        # find sender words that match the length of the cipher sender, sorted by most frequent first
-        potential_senders = self.get_potential_targets(message.sender, self.sender_frequency)
-        # the pattern of differences between characters in a group must be the same for all groups to match a target word
-        sender_groups = self.make_groups(message.sender)
-        sender_diffs = self.make_diffs(sender_groups)
-        for potential_sender in potential_senders:
-            potential_sender_groups = self.make_groups(potential_sender)
-            potential_sender_diffs = self.make_diffs(potential_sender_groups)
-            if sender_diffs == potential_sender_diffs:
-                code_diff = self.code_diff_from_groups_with_same_diff(potential_sender_groups, sender_groups)
-                # we can only show the user the source word and target word, since we don't know the position of the code between words.
-                if self.handle_potential_match("the sender", message.sender, potential_sender, code_diff):
-                    return True
+        return self.handle_word_decoding("the sender", message.sender, self.sender_frequency)
 
     def handle_body_decoding(self, message: Message) -> Optional[bool]:
         # similar to the sender, but we have a list of words to find targets for.
         # we should check words largest to smallest, since the larger words should produce less false positives (less calls to is_clear_text)
 
         # check the bigest words first, since they are more likely to get a full code
-        sorted_body_words = sorted(message.body, key=len, reverse=True)
+        # words that are already in the dictionary are probably ocr'd clear text, so try them after the real misses
+        sorted_body_words = sorted(message.body, key=lambda word: (word in self.dictionary_words, -len(word)))
         for body_word in sorted_body_words:
-            potential_body_words = self.get_potential_targets(body_word, self.word_frequency)
-            # the pattern of differences between characters in a group must be the same for all groups to match a target word
-            body_word_groups = self.make_groups(body_word)
-            body_word_diffs = self.make_diffs(body_word_groups)
-            for potential_body_word in potential_body_words:
-                potential_body_word_groups = self.make_groups(potential_body_word)
-                potential_body_word_diffs = self.make_diffs(potential_body_word_groups)
-                if body_word_diffs == potential_body_word_diffs:
-                    code_diff = self.code_diff_from_groups_with_same_diff(potential_body_word_groups, body_word_groups)
-                    # we can only show the user the source word and target word, since we don't know the position of the code between words.
-                    if self.handle_potential_match("a body word", body_word, potential_body_word, code_diff):
-                        return True
+            if self.handle_word_decoding("a body word", body_word, self.word_frequency):
+                return True
 
     def handle_cipher_text(self, message: Message):
         if (
@@ -269,7 +208,7 @@ class Main:
             print("Enter q to quit or anything else to grab a new image.")
             if input() == "q":
                 break
-            message = Message()
+            message = Message(api=self.ocr_api)
             if not message.text:
                 print("We couldn't find any text in the image.")
                 continue
@@ -297,6 +236,8 @@ class Main:
             self.sender_frequency.save()
             self.word_frequency.save()
             self.seen_messages.save()
+        if self.ocr_api:
+            self.ocr_api.End()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,68 @@
+import string
+from functools import lru_cache
+
+from src.globals import CODE_BASE, GROUP_COUNT
+
+
+# the characters a nob turns through, in order, the custom ord of a character is its position
+CODE_ALPHABET = string.ascii_uppercase + string.digits
+
+# lookup table from ascii to custom ord values, works with bytes.translate so a whole word is converted in one pass
+INVALID_ORD = 255
+ORD_TABLE = bytes(CODE_ALPHABET.index(chr(i)) if chr(i) in CODE_ALPHABET else INVALID_ORD for i in range(256))
+
+
+@lru_cache(maxsize=4096)
+def encode_word(word: str) -> bytes:
+    # the custom ord of every character in the word
+    # cached, since dictionary words are encoded again for every match they're a candidate for
+    codes = word.encode("ascii").translate(ORD_TABLE)
+    if INVALID_ORD in codes:
+        raise ValueError(f"Invalid word {word}")
+    return codes
+
+
+def code_diff_from_words_with_same_diff(target_word: str, source_word: str) -> tuple[int]:
+    # these words have the same differences, so return the amount of shifts needed to get from source to target, once for each group
+    # the first GROUP_COUNT characters are the first character of each group
+    # if the word isn't long enough return a partial code
+    target_codes = encode_word(code_characters(target_word))[:GROUP_COUNT]
+    source_codes = encode_word(code_characters(source_word))[:GROUP_COUNT]
+    return tuple((source - target) % CODE_BASE for target, source in zip(target_codes, source_codes))
+
+
+def code_characters(word: str) -> str:
+    # dashes aren't in the code alphabet, so the code can't turn them, they're left in place
+    return word.replace("-", "")
+
+
+# diffs are between 0 and 35, so they fit in 6 bits, leaving 63 free to separate groups
+DIFF_BITS = 6
+GROUP_SEPARATOR = (1 << DIFF_BITS) - 1
+
+
+@lru_cache(maxsize=4096)
+def fingerprint(word: str) -> int:
+    # pack the pattern of differences into a single int, so comparing and hashing patterns is cheap
+    # divide letters in groups of GROUP_COUNT, via round robin
+    # get the pattern of differences between character in a group, using custom ord
+    # the nobs wrap around, so the differences do too
+    # the differences are packed as they're made, without building a tuple of them first
+    codes = encode_word(word)
+    packed = 0
+    for start in range(GROUP_COUNT):
+        group = codes[start::GROUP_COUNT]
+        for x, y in zip(group, group[1:]):
+            packed = (packed << DIFF_BITS) | (x - y) % CODE_BASE
+        packed = (packed << DIFF_BITS) | GROUP_SEPARATOR
+    return packed
+
+
+@lru_cache(maxsize=4096)
+def signature(word: str) -> tuple[int, tuple[int], int]:
+    # words can only match if they're the same length, have dashes in the same places,
+    # and the characters around the dashes have the same pattern of differences
+    # bounded like valid_word, every ocr'd cipher token comes through here, misreads and all
+    # the frequency index already keeps each of its words in their signature's bucket, so they don't need to stay cached
+    dashes = tuple(index for index, char in enumerate(word) if char == "-")
+    return len(word), dashes, fingerprint(code_characters(word))
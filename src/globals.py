@@ -1,2 +1,3 @@
 DO_STRETCH = False
 GROUP_COUNT = 4  # the amount of nobs in highfleet decryption codes.
+CODE_BASE = 36  # the amount of values on a nob, A-Z then 0-9.
@@ -1,27 +1,84 @@
-import csv
 from functools import lru_cache
-from operator import itemgetter
-import string
+import hashlib
+import re
 from typing import Optional
 
-import pytesseract
 from PIL import Image, ImageGrab
 
+try:
+    from tesserocr import PyTessBaseAPI, RIL, iterate_level
+except ImportError:
+    # tesserocr can be hard to install, especially on windows, so fall back to running tesseract through pytesseract
+    PyTessBaseAPI = None
+    import pytesseract
+
 from src.globals import DO_STRETCH
 
 
-REPLACEMENT_WORD_CACHE = {}
+# text and data of recent captures, keyed by the captured pixels, so grabbing an unchanged screen skips tesseract
+OCR_CACHE: dict[tuple[tuple[int, int], bytes], tuple[str, dict[str, list]]] = {}
+OCR_CACHE_SIZE = 8
+# the word data is kept a list per field, rather than a dict per word
+DATA_KEYS = ("left", "top", "width", "height", "conf", "text")
+# letters and dashes, all numbers, or a receiver or sender with an equals sign, never starting or ending with a dash
+VALID_WORD_PATTERN = re.compile(r"(?!-)(?:[A-Z-]+|[0-9]+|=.*|.*=)(?<!-)", re.DOTALL)
+# user corrections can also mix letters and numbers, and be several words
+VALID_MIXED_WORD_PATTERN = re.compile(r"(?!-)(?:[A-Z0-9 -]+|=.*|.*=)(?<!-)", re.DOTALL)
+# splits text into alternating whitespace and words, in one scan
+TEXT_PARTS_PATTERN = re.compile(r"(\S+)")
+
+
+@lru_cache(maxsize=4096)
+def valid_word(word: str, allow_mixed=False) -> bool:
+    # the same words are checked again for every message, and by every instance
+    pattern = VALID_MIXED_WORD_PATTERN if allow_mixed else VALID_WORD_PATTERN
+    return bool(pattern.fullmatch(word))
+
+
+@lru_cache(maxsize=None)
+def screen_size() -> tuple[int, int]:
+    # the capture box scales with the screen, but a full screen grab is a lot of pixels to throw away every capture
+    # the resolution doesn't change while the game is running, so only measure it once
+    full_screen = ImageGrab.grab(include_layered_windows=True)
+    return full_screen.width, full_screen.height
 
 
 class Message:
-    def __init__(self, text: Optional[str] = None):
+    __slots__ = (
+        "ocred",
+        "api",
+        "_text",
+        "_corrected_text",
+        "_image",
+        "_data",
+        "_recognized",
+        "_raw_words",
+        "_raw_scores",
+        "_text_parts",
+        "_word_parts",
+        "_corrected_words",
+        "_words",
+        "_receiver",
+        "_sender",
+        "_body",
+    )
+
+    def __init__(self, text: Optional[str] = None, api: Optional["PyTessBaseAPI"] = None):
         self.ocred = not text
+        # the tesseract api is expensive to create, so the caller owns it and shares it between messages
+        # without tesserocr installed there is no api, and pytesseract runs tesseract instead
+        self.api = api
         self._text = text
         self._corrected_text: Optional[str] = None
         self._image: Optional[Image.Image] = None
-        self._data: Optional[dict] = None
+        self._data: Optional[dict[str, list]] = None
+        self._recognized = False
         self._raw_words: Optional[list[str]] = None
         self._raw_scores: Optional[list[float]] = None
+        # the text split into alternating whitespace and words, so corrections can be joined back in one pass
+        self._text_parts: Optional[list[str]] = None
+        # for each corrected word, the index of the text part it's rendered into, if it was found in the text
+        self._word_parts: Optional[list[Optional[int]]] = None
         self._corrected_words: Optional[list[str]] = None
         self._words: Optional[tuple[str]] = None
         self._receiver: Optional[str] = None
@@ -37,52 +94,93 @@ class Message:
             # At 1920x1200, the box would be (8, 981, 571, 1136) if not stretched
             # At 1920x1200 stretched, the box would at approximately (9, 1080, 634, 1195)
             # if the ratio is not 16:9, we need to stretch our crop box.
-            full_screen = ImageGrab.grab(include_layered_windows=True)
+            width, height = screen_size()
             bbox = (78, 981, 571, 1136)
             if DO_STRETCH:
                 bbox = (79, 1080, 634, 1195)
-            # scale for width and height of the full_screen
+            # scale for width and height of the screen
             bbox = (
-                int(bbox[0] * full_screen.width / 1920),
-                int(bbox[1] * full_screen.height / 1200),
-                int(bbox[2] * full_screen.width / 1920),
-                int(bbox[3] * full_screen.height / 1200),
+                int(bbox[0] * width / 1920),
+                int(bbox[1] * height / 1200),
+                int(bbox[2] * width / 1920),
+                int(bbox[3] * height / 1200),
             )
             self._image = ImageGrab.grab(bbox=bbox, include_layered_windows=True)
             # convert to greyscale
             self._image = self._image.convert("L")
         return self._image
 
+    def recognize(self):
+        # text and data both read from the same recognition, so only run it once
+        if not self._recognized:
+            assert self.ocred
+            image = self.image
+            pixels = image.tobytes()
+            key = (image.size, hashlib.blake2b(pixels, digest_size=16).digest())
+            if key not in OCR_CACHE:
+                # pytesseract is only imported when tesserocr isn't installed, otherwise the caller has to pass an api
+                if PyTessBaseAPI is not None:
+                    assert self.api
+                    # the image is greyscale, one byte a pixel, so give tesseract the raw pixels, not a PIL encoding
+                    self.api.SetImageBytes(pixels, image.width, image.height, 1, image.width)
+                    self.api.Recognize()
+                    OCR_CACHE[key] = (self.api.GetUTF8Text(), self.read_data())
+                else:
+                    OCR_CACHE[key] = self.run_pytesseract()
+                # forget the oldest capture
+                if len(OCR_CACHE) > OCR_CACHE_SIZE:
+                    del OCR_CACHE[next(iter(OCR_CACHE))]
+            self._text, self._data = OCR_CACHE[key]
+            self._recognized = True
+
+    def read_data(self) -> dict[str, list]:
+        # walk the recognized words directly instead of round tripping through tesseract's tsv output
+        data = {key: [] for key in DATA_KEYS}
+        iterator = self.api.GetIterator()
+        # a blank capture has no iterator, or one that sits on nothing
+        if iterator is None:
+            return data
+        for word in iterate_level(iterator, RIL.WORD):
+            bounding_box = word.BoundingBox(RIL.WORD)
+            if bounding_box is None:
+                continue
+            left, top, right, bottom = bounding_box
+            data["left"].append(left)
+            data["top"].append(top)
+            data["width"].append(right - left)
+            data["height"].append(bottom - top)
+            data["conf"].append(word.Confidence(RIL.WORD))
+            data["text"].append(word.GetUTF8Text(RIL.WORD) or "")
+        return data
+
+    def run_pytesseract(self) -> tuple[str, dict[str, list]]:
+        # the same page segmentation the tesserocr api is created with, a single block of text
+        # each pytesseract call runs tesseract again, so only get the data and rebuild the text from it
+        data = pytesseract.image_to_data(self.image, config="--psm 6", output_type=pytesseract.Output.DICT)
+        # level 5 rows are words, the rest are the blocks, paragraphs and lines they're in
+        words = {key: [] for key in DATA_KEYS}
+        lines = {}
+        for index, level in enumerate(data["level"]):
+            if level == 5:
+                for key in DATA_KEYS:
+                    words[key].append(data[key][index])
+                line = (data["block_num"][index], data["par_num"][index], data["line_num"][index])
+                lines.setdefault(line, []).append(data["text"][index])
+        text = "\n".join(" ".join(filter(None, line_words)) for line_words in lines.values())
+        return text, words
+
     @property
     def text(self) -> str:
         if not self._text:
-            assert self.ocred
-            self._text = pytesseract.image_to_string(self.image)
+            self.recognize()
         return self._text
 
     @property
-    def data(self) -> dict:
+    def data(self) -> dict[str, list]:
         if not self.ocred:
             raise ValueError("Cannot get data of unocred message")
         if not self._data:
-            tsv_data = pytesseract.image_to_data(self.image)
-            tsv_reader = csv.reader(tsv_data.splitlines(), delimiter="\t")
-            headers = [x.lower() for x in next(tsv_reader)]
-            assert headers == [
-                "level",
-                "page_num",
-                "block_num",
-                "par_num",
-                "line_num",
-                "word_num",
-                "left",
-                "top",
-                "width",
-                "height",
-                "conf",
-                "text",
-            ]
-            self._data = [dict(zip(headers, row)) for row in tsv_reader]
+            self.recognize()
         return self._data
 
     @property
@@ -90,7 +188,8 @@ class Message:
         if not self._raw_words:
             if self.ocred:
                 # todo: deal with low confidence words
-                raw = list(filter(itemgetter(0), [(x["text"].strip(), x["conf"]) for x in self.data if x["text"]]))
+                data = self.data
+                raw = [(word, conf) for text, conf in zip(data["text"], data["conf"]) if (word := text.strip())]
                 self._raw_words = [x[0] for x in raw]
                 self._raw_scores = [x[1] for x in raw]
                 # remove low confidence words
@@ -98,126 +197,96 @@ class Message:
                 #     if float(score) < 50:
                 #         del self._raw_words[index]
                 #         del self._raw_scores[index]
-
+                self.locate_raw_words()
             else:
-                self._raw_words = list(filter(None, [x.strip() for x in self.text.split()]))
+                # typed text is its own list of words, so the words and where they are come from the same split
+                self._text_parts = TEXT_PARTS_PATTERN.split(self.text)
+                self._raw_words = self._text_parts[1::2]
+                self._word_parts = list(range(1, len(self._text_parts), 2))
             assert all(self._raw_words)
         return self._raw_words
 
-    @lru_cache
-    def valid_word(self, word: str, allow_mixed=False) -> bool:
-        indicators = word and (
-            all(c in string.ascii_uppercase + "-" for c in word)
-            or all(c in string.digits for c in word)
-            or word.startswith("=")
-            or word.endswith("=")
-            or (allow_mixed and all(c in (string.ascii_uppercase + "-" + string.digits + " ") for c in word))
-        )
-        contra_indicators = not word or word.startswith("-") or word.endswith("-")
-        return not contra_indicators and indicators
+    def locate_raw_words(self):
+        # find each raw word in the text, in order, so they can be corrected in place
+        self._text_parts = TEXT_PARTS_PATTERN.split(self.text)
+        self._word_parts = []
+        next_part = 1
+        for word in self._raw_words:
+            found = None
+            for part in range(next_part, len(self._text_parts), 2):
+                if self._text_parts[part] == word:
+                    found = part
+                    next_part = part + 2
+                    break
+            self._word_parts.append(found)
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def correct_word(word: str) -> str:
+        # pytesseract seems to figure out 0 and Os using context clues.
+        # The "1"s and "I"s in highfleet's font confuse it. we need to replace 1 with I in words that are mostly characters and I with 1 in words that are mostly numbers
+        # the same words turn up in message after message, so each is only corrected once
+        if valid_word(word):
+            return word
+        if "I" in word:
+            # if the non I characters are mostly numbers, replace I with 1
+            # I isn't a digit, so it doesn't need removing before counting
+            number_count = sum(map(str.isdigit, word))
+            if number_count > len(word) / 2:
+                return word.replace("I", "1")
+        if "1" in word:
+            # if the non 1 characters are mostly letters, replace 1 with I
+            letter_count = sum(map(str.isalpha, word))
+            if letter_count > len(word) / 2:
+                return word.replace("1", "I")
+        # pound signs are sometimes 1s
+        if "£" in word:
+            replaced = word.replace("£", "1")
+            if valid_word(replaced):
+                return replaced
+        # fallthrough, the user can deal with this later
+        return word
 
     @property
     def corrected_words(self) -> list[str]:
         if not self._corrected_words:
-            # pytesseract seems to figure out 0 and Os using context clues.
-            # The "1"s and "I"s in highfleet's font confuse it. we need to replace 1 with I in words that are mostly characters and I with 1 in words that are mostly numbers
-            self._corrected_words = []
-            new_replacement_words = {}
-            for word in self.raw_words:
-                if word in REPLACEMENT_WORD_CACHE:
-                    if REPLACEMENT_WORD_CACHE[word] is None:
-                        self._corrected_words.append("")
-                        continue
-                    self._corrected_words.append(REPLACEMENT_WORD_CACHE[word])
-                    continue
-                elif word in new_replacement_words:
-                    if new_replacement_words[word] is None:
-                        self._corrected_words.append("")
-                        continue
-                    self._corrected_words.append(new_replacement_words[word])
-                    continue
-                elif self.valid_word(word):
-                    self._corrected_words.append(word)
-                    new_replacement_words[word] = word
-                    continue
-                elif "I" in word:
-                    # if the non I characters are mostly numbers, replace I with 1
-                    number_count = sum(c.isdigit() for c in word.replace("I", ""))
-                    if number_count > len(word) / 2:
-                        replaced = word.replace("I", "1")
-                        self._corrected_words.append(replaced)
-                        new_replacement_words[word] = replaced
-                        continue
-                if "1" in word:
-                    # if the non 1 characters are mostly letters, replace 1 with I
-                    letter_count = sum(c.isalpha() for c in word.replace("1", ""))
-                    if letter_count > len(word) / 2:
-                        replaced = word.replace("1", "I")
-                        self._corrected_words.append(replaced)
-                        new_replacement_words[word] = replaced
-                        continue
-                # pound signs are sometimes 1s
-                if "£" in word:
-                    replaced = word.replace("£", "1")
-                    if self.valid_word(replaced):
-                        self._corrected_words.append(replaced)
-                        new_replacement_words[word] = replaced
-                        continue
-                # fallthrough, the user can deal with this later
-                self._corrected_words.append(word)
-            for index, (new_word, old_word) in enumerate(zip(self._corrected_words, self._raw_words)):
-                if new_word != old_word:
-                    self.update_text_by_index(self._text, self.raw_words, index, new_word)
-            REPLACEMENT_WORD_CACHE.update(new_replacement_words)
+            self._corrected_words = [self.correct_word(word) for word in self.raw_words]
+            for new_word, part in zip(self._corrected_words, self._word_parts):
+                if part is not None:
+                    self._text_parts[part] = new_word
         return self._corrected_words
 
-    @staticmethod
-    def update_text_by_index(text: str, words: list[str], new_word_index: int, new_word: str) -> str:
-        # if new_word is duplicated in the list, we need to figure out which one we're replacing
-        duplicate_indices = [index for index, word in enumerate(words) if word == new_word]
-        # we are assuming the words list is in order of appearance in the text, at least for duplicates
-        if len(duplicate_indices) > 1:
-            # replace the duplicates with unique markers that are unlikely to be in the text
-            for index in duplicate_indices:
-                text = text.replace(words[index], f"**{index}**", 1)
-            # replace the one we want
-            text = text.replace(f"**{new_word_index}**", new_word, 1)
-            # replace the rest of the duplicates
-            for index in duplicate_indices:
-                if index != new_word_index:
-                    text = text.replace(f"**{index}**", words[index], 1)
-        else:
-            text = text.replace(words[new_word_index], new_word, 1)
-        return text
-
     @property
     def corrected_text(self) -> str:
         if not self._corrected_text:
-            # _corrected_text is updated via update_corrected_word
-            self._corrected_text = self._text
+            # make sure the automatic corrections are in the text parts
+            self.corrected_words
+            self._corrected_text = "".join(self._text_parts)
         return self._corrected_text
 
     def clear_words_after_corrected_words(self):
+        self._corrected_text = None
         self._words = None
         self._body = None
         self._receiver = None
         self._sender = None
 
     def update_corrected_word(self, index: int, new_word: str):
-        self._corrected_text = self.update_text_by_index(self.corrected_text, self.corrected_words, index, new_word)
         new_words = new_word.split(" ")
-        if len(new_words) > 1:
-            self._corrected_words[index] = new_words[0]
-            for i, word in enumerate(new_words[1:]):
-                self._corrected_words.insert(index + i, word)
-        else:
-            self._corrected_words[index] = new_word
+        part = self._word_parts[index]
+        self._corrected_words[index : index + 1] = new_words
+        self._word_parts[index : index + 1] = [part] * len(new_words)
+        if part is not None:
+            # words split from a correction share its part of the text
+            self._text_parts[part] = " ".join(
+                word for word, word_part in zip(self._corrected_words, self._word_parts) if word_part == part and word
+            )
         self.clear_words_after_corrected_words()
 
     @property
     def words(self) -> tuple[str]:
         if not self._words:
-            self._words = tuple(filter(None, [x for x in self.corrected_words if x]))
+            self._words = tuple(filter(None, self.corrected_words))
             assert all(self._words)
         return self._words
 
@@ -227,9 +296,8 @@ class Message:
         # the sender can be missing
         # return sans equals sign
         if not self._sender:
-            self._sender = (
-                self.words[-1].lstrip("=") if self.words and self.words[-1].startswith("=") else None
-            ) or None
+            words = self.words
+            self._sender = (words[-1].lstrip("=") if words and words[-1].startswith("=") else None) or None
         return self._sender
 
     @property
@@ -238,7 +306,8 @@ class Message:
         # the receiver can be missing
         # return sans equals sign
         if not self._receiver:
-            self._receiver = (self.words[0].rstrip("=") if self.words and self.words[0].endswith("=") else None) or None
+            words = self.words
+            self._receiver = (words[0].rstrip("=") if words and words[0].endswith("=") else None) or None
         return self._receiver
 
     @property
@@ -257,20 +326,17 @@ class Message:
             if replacement == "":
                 # leave loop with no replacement
                 break
-            if self.valid_word(replacement, allow_mixed=True):
+            if valid_word(replacement, allow_mixed=True):
                 # leave loop with replacement
                 break
         return replacement
 
-    def get_word_translations(self, translation_table: dict[int, str]) -> str:
-        # get all the words in order, translate them and update the text to return
-        cipher_words = [self.receiver] + list(self.body) + [self.sender]
+    def get_word_translations(self, translation_table: dict[int, str]) -> dict[str, str]:
+        # get all the words in order and translate them
+        cipher_words = [word for word in [self.receiver, *self.body, self.sender] if word]
         clear_words = [str.translate(word, translation_table) for word in cipher_words]
         return dict(zip(cipher_words, clear_words))
 
     def get_clear_text(self, translation_table: dict[int, str]) -> str:
-        cipher_words_to_clear_words = self.get_word_translations(translation_table)
-        clear_text = self.corrected_text
-        for key, value in cipher_words_to_clear_words.items():
-            clear_text = clear_text.replace(key, value, 1)
-        return clear_text
+        # the same table applies to every word, so translate the whole text at once
+        return self.corrected_text.translate(translation_table)
@@ -1,7 +1,28 @@
+import io
 import json
+import os
+import sys
+from types import SimpleNamespace
 
+import ijson
 from tqdm import tqdm
-from typing import Optional
+from typing import Callable, Hashable, Optional
+
+try:
+    # orjson parses and writes json several times faster, but it's optional
+    import orjson
+except ImportError:
+    orjson = None
+
+# picked once, the load loops call it for every line
+json_loads = orjson.loads if orjson else json.loads
+
+
+def json_dumps(value, indent: bool = False) -> bytes:
+    # bytes either way, so callers can write to binary files without caring which library made them
+    if orjson:
+        return orjson.dumps(value, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(value, indent=2 if indent else None).encode()
 
 
 class AppendOnlyFileBackedSet(set):
@@ -12,86 +33,208 @@ class AppendOnlyFileBackedSet(set):
         self.filename = filename
         self.desc = desc
         self.unit = unit
-        self.dirty_items = set()
+        # items already in the set are never added again, so this doesn't need to be a set itself
+        self.dirty_items = []
         self.is_json = is_json
         self.upper_case = upper_case
 
     def add(self, item):
-        super().add(item)
-        self.dirty_items.add(item)
+        # anything already in the set is already saved, or waiting to be
+        if item not in self:
+            super().add(item)
+            self.dirty_items.append(item)
 
     def remove(self, _item):
         raise NotImplementedError("This set is append only")
 
     def load(self):
         try:
-            with open(self.filename, "r") as f:
-                for line in tqdm(
-                    f.readlines(),
+            # saves write utf-8 whatever the locale, so read it back the same way
+            with open(self.filename, "r", encoding="utf-8") as f:
+                # stream the lines through, rather than reading them all into a list first
+                lines = tqdm(
+                    f,
                     desc=f"Loading {self.desc}",
                     unit=self.unit,
                     colour="green",
                     ascii=True,
-                ):
-                    line = line.strip()
-                    if self.is_json:
-                        line = json.loads(line)
-                    if self.upper_case:
-                        line = line.upper()
-                    super().add(line)
+                )
+                if self.is_json:
+                    # json allows whitespace around a value, so the newline doesn't need stripping first
+                    lines = (json_loads(line) for line in lines)
+                else:
+                    lines = (line.strip() for line in lines)
+                if self.upper_case:
+                    # interned, since the same words turn up again as message words and frequency keys
+                    lines = (sys.intern(line.upper()) for line in lines)
+                super().update(lines)
         except FileNotFoundError:
             # make it for next time.
             with open(self.filename, "w"):
                 pass
 
     def save(self):
-        with open(self.filename, "a") as f:
-            for item in tqdm(
-                self.dirty_items,
-                desc=f"Saving {self.desc}",
-                unit=self.unit,
-                colour="green",
-                ascii=True,
-            ):
-                f.write(f"{json.dumps(item)}\n" if self.is_json else f"{item}\n")
-        self.dirty_items = set()
+        if not self.dirty_items:
+            return
+        # build the whole batch first, so it's one write and one sync no matter how many items there are
+        buffer = io.BytesIO()
+        for item in tqdm(
+            self.dirty_items,
+            desc=f"Saving {self.desc}",
+            unit=self.unit,
+            colour="green",
+            ascii=True,
+        ):
+            buffer.write(json_dumps(item) if self.is_json else item.encode())
+            buffer.write(b"\n")
+        with open(self.filename, "ab") as f:
+            f.write(buffer.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+        self.dirty_items = []
 
 
 class JSONBackedDict(dict):
-    def __init__(self, filename: str, desc: str, unit: str, *args, **kwargs):
+    def __init__(
+        self,
+        filename: str,
+        desc: str,
+        unit: str,
+        *args,
+        index_key: Callable[[str], Optional[Hashable]] = len,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
         self.filename = filename
+        # changes since the last compact are appended here, instead of rewriting the whole file every save
+        self.log_filename = f"{os.path.splitext(filename)[0]}.jsonl"
         self.desc = desc or "frequency"
         self.unit = unit or " words"
+        self.dirty_keys = set()
+        # keys bucketed by index_key, each sorted by value descending when it's asked for
+        # keys with an index_key of None aren't indexed
+        # the index is built the first time it's asked for, sessions that only record clear text never need it
+        self.index_key = index_key
+        self._index: Optional[dict[Hashable, list[str]]] = None
+        self._unsorted: set[Hashable] = set()
+
+    def _build_index(self):
+        self._index = {}
+        for key in self:
+            index = self.index_key(key)
+            if index is not None:
+                self._index.setdefault(index, []).append(key)
+        self._unsorted = set(self._index)
+
+    def __setitem__(self, key, value):
+        if self._index is not None:
+            index = self.index_key(key)
+            if index is not None:
+                if key not in self:
+                    self._index.setdefault(index, []).append(key)
+                self._unsorted.add(index)
+        super().__setitem__(key, value)
+        self.dirty_keys.add(key)
+
+    def increment(self, key: str):
+        self[key] = self.get(key, 0) + 1
+
+    def sorted_keys(self, index: Hashable) -> list[str]:
+        # keys with the given index_key, largest value first
+        if self._index is None:
+            self._build_index()
+        if index in self._unsorted:
+            self._index[index].sort(key=self.get, reverse=True)
+            self._unsorted.discard(index)
+        return self._index.get(index, [])
 
     def load(self):
+        self.clear()
+        self.dirty_keys = set()
         try:
-            with open(self.filename, "r") as f:
-                json_dict = json.loads(f.read())
-                self.clear()
-                # I just want a cool progress bar
-                for key, value in tqdm(
-                    json_dict.items(),
+            with open(self.filename, "rb") as f:
+                # I just want a cool progress bar, stream the pairs in so there isn't a second copy of the dict
+                with tqdm.wrapattr(
+                    f,
+                    "read",
+                    total=os.fstat(f.fileno()).st_size,
                     desc=f"Loading {self.desc}",
-                    unit=self.unit,
                     colour="green",
                     ascii=True,
-                ):
-                    super().__setitem__(key, value)
+                ) as progress_f:
+                    # ijson reads through readinto when the file has it, which the progress bar can't see
+                    reader = SimpleNamespace(read=progress_f.read)
+                    # one update over the stream, rather than a __setitem__ call per pair
+                    super().update((sys.intern(key), value) for key, value in ijson.kvitems(reader, ""))
         except FileNotFoundError:
             # make it for next time.
             with open(self.filename, "w") as f:
                 f.write("{}")
+        changes = self._replay_log()
+        self._index = None
+        # once the log outgrows the dict, fold it back into the main file
+        if changes > len(self):
+            self.compact()
+
+    def _replay_log(self) -> int:
+        changes = 0
+        try:
+            # the log is written as utf-8 bytes, and both json libraries parse bytes, so skip decoding with the locale
+            with open(self.log_filename, "rb") as f:
+                for line in f:
+                    try:
+                        change = json_loads(line)
+                    except ValueError:
+                        # a save cut short leaves a torn or blank line, skip it rather than refuse to start
+                        continue
+                    super().__setitem__(sys.intern(change["k"]), change["v"])
+                    changes += 1
+        except FileNotFoundError:
+            pass
+        return changes
 
     def save(self):
-        with open(self.filename, "w") as f:
-            json_str = json.dumps(self, indent=4)
-            # I just want a cool progress bar
-            for line in tqdm(
-                json_str.split("\n"),
+        # main saves every dict after every message, most of the time only one of them changed
+        if not self.dirty_keys:
+            return
+        with open(self.log_filename, "a+b") as f:
+            # start on a fresh line if the last save was cut short, so the torn line doesn't swallow this one
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            # sorted, so the log doesn't depend on set order and the same changes always write the same lines
+            for key in tqdm(
+                sorted(self.dirty_keys),
                 desc=f"Saving {self.desc}",
                 unit=self.unit,
                 colour="green",
                 ascii=True,
             ):
-                f.write(f"{line}\n")
+                f.write(json_dumps({"k": key, "v": self[key]}) + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.dirty_keys = set()
+
+    def compact(self):
+        json_bytes = json_dumps(self, indent=True) + b"\n"
+        # the main file is the only full copy, so write the new one beside it and swap it in once it's on disk
+        temp_filename = f"{self.filename}.tmp"
+        with open(temp_filename, "wb") as f:
+            # I just want a cool progress bar, it follows the one write instead of splitting the json into lines
+            with tqdm.wrapattr(
+                f,
+                "write",
+                total=len(json_bytes),
+                desc=f"Compacting {self.desc}",
+                colour="green",
+                ascii=True,
+            ) as progress_f:
+                progress_f.write(json_bytes)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, self.filename)
+        # everything in the log is in the main file now
+        with open(self.log_filename, "w"):
+            pass
+        self.dirty_keys = set()